@@ -300,6 +300,7 @@ struct log {
     ulong tcrc;     /* crc of total data */
     ulong tlen;     /* length (modulo 2^32) of total data */
     time_t lock;    /* last modify time of our lock file */
+    int level;      /* deflate compression level */
 };
 
 /* gzip header for gzlog */
@@ -620,7 +621,7 @@ local int log_compress(struct log *log, unsigned char *data, size_t len)
         strm.zalloc = Z_NULL;
         strm.zfree = Z_NULL;
         strm.opaque = Z_NULL;
-        if (deflateInit2(&strm, Z_DEFAULT_COMPRESSION, Z_DEFLATED, -15, 8,
+        if (deflateInit2(&strm, log->level, Z_DEFLATED, -15, 8,
                          Z_DEFAULT_STRATEGY) != Z_OK)
             return -2;
 
@@ -877,6 +878,7 @@ gzlog *gzlog_open(char *path)
         return NULL;
     strcpy(log->id, LOGID);
     log->fd = -1;
+    log->level = Z_DEFAULT_COMPRESSION;
 
     /* save path and end of path for name construction */
     n = strlen(path);
@@ -1036,6 +1038,23 @@ int gzlog_write(gzlog *logd, void *data, size_t len)
     return gzlog_compress(log);
 }
 
+/* gzlog_level() return values:
+    0: ok
+   -3: invalid log pointer or level argument */
+int gzlog_level(gzlog *logd, int level)
+{
+    struct log *log = logd;
+
+    /* check arguments */
+    if (log == NULL || strcmp(log->id, LOGID))
+        return -3;
+    if (level < Z_DEFAULT_COMPRESSION || level > Z_BEST_COMPRESSION)
+        return -3;
+
+    log->level = level;
+    return 0;
+}
+
 /* gzlog_close() return values:
     0: ok
    -3: invalid log pointer argument */
@@ -29,6 +29,7 @@
                      gzlog_write() now always leaves the log file as valid gzip
    2.1   8 Jul 2012  Fix argument checks in gzlog_compress() and gzlog_write()
    2.2  14 Aug 2012  Clean up signed comparisons
+   2.2m              Add gzlog_level() to set the compression level (mimir)
  */
 
 /*
@@ -84,6 +85,12 @@ int gzlog_write(gzlog *log, void *data, size_t len);
    gzlog_write(). */
 int gzlog_compress(gzlog *log);
 
+/* Set the deflate compression level used when the log is compressed, from 0
+   (no compression) to 9 (best compression), or -1 for the zlib default.
+   Lower levels compress faster at the cost of a larger file.  Return zero on
+   success, or -3 if the log or level argument is invalid. */
+int gzlog_level(gzlog *log, int level);
+
 /* Close a gzlog object.  Return zero on success, -3 if the log argument is
    invalid.  The log object is freed, and so cannot be referenced again. */
 int gzlog_close(gzlog *log);
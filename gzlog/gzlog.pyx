@@ -6,6 +6,7 @@ cdef extern from "cgzlog.h":
     gzlog* gzlog_open(char *path)
     int gzlog_write(gzlog* log, void* data, size_t len)
     int gzlog_compress(gzlog* log)
+    int gzlog_level(gzlog* log, int level)
     int gzlog_close(gzlog* log)
 
 cdef extern from "cgzlog.c":
@@ -20,10 +21,13 @@ cdef class Gzlog:
     """This type extension managed the gzlog object."""
     cdef gzlog* _gzlog  # Pointer to log struct
     cdef bint _dirty  # Data to be compressed/flushed?
-    def __cinit__(self, path):
+    def __cinit__(self, path, int compresslevel=-1):
+        if not -1 <= compresslevel <= 9:
+            raise ValueError('invalid compression level')
         self._gzlog = gzlog_open(path.encode('utf-8'))
         if self._gzlog == NULL:
             raise IOError
+        self._raise(gzlog_level(self._gzlog, compresslevel))
         self._dirty = False
 
     def fileno(self):
@@ -81,6 +85,9 @@ class GZipLog(io.RawIOBase):
     ----------
     path : str
         The path to create the log at. Note that .gz will be appended.
+    compresslevel : int, optional
+        The compression level from 0 to 9, or -1 (the default) for the
+        zlib default level.
 
     """
     # We can't do multiple inheritence with Gzlog as well (instance
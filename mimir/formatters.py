@@ -1,14 +1,27 @@
 """Formatters for printing log entries in human-readable format."""
-from __future__ import print_function
 
-import six
+# Indentation strings for each nesting level, so they're only built once
+_PADS = tuple('  ' * i for i in range(64))
 
 
-def simple_formatter(entry, fp, indent=0):
-    """Called with the entry and the file to write to."""
-    for key, value in six.iteritems(entry):
-        if isinstance(value, dict):
-            print('{}{}:'.format('  ' * indent, key))
-            simple_formatter(value, fp, indent + 1)
+def simple_formatter(entry, fp, indent=0, _pads=_PADS):
+    """Called with the entry and the file to write to.
+
+    Nested dictionaries are walked iteratively and the formatted entry is
+    written to the file in a single call.
+
+    """
+    lines = []
+    stack = [(iter(entry.items()), indent)]
+    while stack:
+        items, indent = stack[-1]
+        pad = _pads[indent] if indent < len(_pads) else '  ' * indent
+        for key, value in items:
+            if isinstance(value, dict):
+                lines.extend((pad, str(key), ':\n'))
+                stack.append((iter(value.items()), indent + 1))
+                break
+            lines.extend((pad, str(key), ': ', str(value), '\n'))
         else:
-            print('{}{}: {}'.format('  ' * indent, key, value), file=fp)
+            stack.pop()
+    fp.write(''.join(lines))
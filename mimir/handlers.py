@@ -1,14 +1,23 @@
 import abc
 import io
+import itertools
+import os
 import sys
 import threading
+import weakref
 from collections import deque
 
 import six
 import zmq
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 from . import gzlog
-from .utils import zpipe
+
+# Numbers the inproc endpoints used to stop the snapshot threads
+_control_counter = itertools.count()
 
 
 @six.add_metaclass(abc.ABCMeta)
@@ -20,8 +29,14 @@ class Handler(object):
     filters : iterable
         An iterable of functions which will be applied to the incoming
         entry. If the `JSON` attribute of the handler is true, the entry
-        will be a serialized JSON object (i.e. a string). If it is false,
-        the entry will be a JSON-compatible dictionary.
+        will be a serialized JSON object (i.e. UTF-8 encoded bytes). If it
+        is false, the entry will be a JSON-compatible dictionary.
+    predicate : callable, optional
+        A function that is called with each (unfiltered) entry and returns
+        whether this handler should handle it, e.g. to only print every
+        100th iteration. The entry is only filtered and serialized for this
+        handler if the predicate returns true. If `None` (the default) all
+        entries are handled.
 
     Attributes
     ----------
@@ -30,21 +45,59 @@ class Handler(object):
         `False` the original (but filtered) entry will be received instead.
         This allows JSON serialization to be done only once for all the
         handlers. By default, this is false.
-    filters : iterable
-        The filters applied to each entry. Can be changed in place in order
-        to change the filtering behavior of the handler.
+    filters : tuple
+        The filters applied to each entry. Can be assigned a new iterable
+        of filters in order to change the filtering behavior of the
+        handler, after which the loggers using this handler are updated.
+        Because it is a tuple it can't be changed in place.
+    predicate : callable or None
+        The predicate deciding which entries are handled. Can be assigned
+        in the same way as the filters.
 
     """
     JSON = False
 
-    def __init__(self, filters=None):
+    def __init__(self, filters=None, predicate=None):
         if not filters:
-            filters = []
+            filters = ()
+        # Loggers register themselves here so that they can be told when
+        # the filters or predicate change
+        self._loggers = weakref.WeakSet()
         self.filters = filters
+        self.predicate = predicate
+
+    @property
+    def filters(self):
+        return self._filters
+
+    @filters.setter
+    def filters(self, filters):
+        self._filters = tuple(filters)
+        # Hashable key so that loggers can share filtered entries between
+        # handlers with the same filters
+        self._filters_key = frozenset(self._filters)
+        self._filter_chain = _chain(self._filters)
+        self._notify_loggers()
+
+    @property
+    def predicate(self):
+        return self._predicate
+
+    @predicate.setter
+    def predicate(self, predicate):
+        self._predicate = predicate
+        self._notify_loggers()
+
+    def _notify_loggers(self):
+        for logger in list(self._loggers):
+            if self in logger.handlers:
+                logger._plan_handlers()
+            else:
+                self._loggers.discard(logger)
 
     def filter(self, entry):
-        for filter in self.filters:
-            entry = filter(entry)
+        """Apply the filters to the entry in order."""
+        return self._filter_chain(entry)
 
     def close(self):
         pass
@@ -54,6 +107,17 @@ class Handler(object):
         raise NotImplementedError
 
 
+def _chain(filters):
+    """Generate a function that applies the filters in order."""
+    namespace = {}
+    call = 'entry'
+    for i, filter in enumerate(filters):
+        namespace['f{}'.format(i)] = filter
+        call = 'f{}({})'.format(i, call)
+    exec('def chain(entry):\n    return {}'.format(call), namespace)
+    return namespace.pop('chain')
+
+
 class FileHandler(Handler):
     """Handler that owns a file object."""
     def close(self):
@@ -92,18 +156,33 @@ class JSONHandler(FileHandler):
     Parameters
     ----------
     fp : fileobj
-        A file-like object (with the `.write()` method) to write the
-        line-delimited JSON formatted log to.
+        A file-like object (with the `.write()` method) opened in binary
+        mode to write the line-delimited JSON formatted log to.
+    fsync : bool, optional
+        If `True`, the file is flushed and synced to disk on closing, so
+        that the log survives a system crash after closing. Defaults to
+        `False`.
 
     """
     JSON = True
 
-    def __init__(self, fp, **kwargs):
+    def __init__(self, fp, fsync=False, **kwargs):
         super(JSONHandler, self).__init__(**kwargs)
+        if isinstance(fp, io.TextIOBase):
+            raise ValueError('JSONHandler requires a file opened in binary '
+                             'mode')
         self.fp = fp
+        self.fsync = fsync
 
     def log(self, entry):
-        self.fp.write(entry + '\n')
+        self.fp.write(entry + b'\n')
+
+    def close(self):
+        """Sync the file to disk if requested and close it."""
+        if self.fsync and not self.fp.closed:
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+        super(JSONHandler, self).close()
 
 
 class GzipJSONHandler(FileHandler):
@@ -122,6 +201,13 @@ class GzipJSONHandler(FileHandler):
         data can be lost. It is set to true by default since it can give
         significant overhead otherwise for experiments that perform large
         amounts of logging.
+    buffer_size : int, optional
+        The size of the write buffer in bytes when `buffered` is true.
+        Larger buffers mean that more entries are compressed at once, but
+        also that more entries are lost on a crash. Defaults to 1 MiB.
+    compresslevel : int, optional
+        The zlib compression level from 0 to 9. Log entries compress well,
+        so by default the fastest level (1) is used.
 
     .. _gzlog:
        https://github.com/madler/zlib/blob/master/examples/gzlog.c
@@ -129,49 +215,183 @@ class GzipJSONHandler(FileHandler):
     """
     JSON = True
 
-    def __init__(self, filename, buffered=True, **kwargs):
+    def __init__(self, filename, buffered=True, buffer_size=1 << 20,
+                 compresslevel=1, **kwargs):
         super(GzipJSONHandler, self).__init__(**kwargs)
-        stream = gzlog.GZipLog(filename)
+        stream = gzlog.GZipLog(filename, compresslevel)
         if buffered:
-            stream = io.BufferedWriter(stream)
-        self.fp = io.TextIOWrapper(stream)
+            stream = io.BufferedWriter(stream, buffer_size=buffer_size)
+        self.fp = stream
+
+    def log(self, entry):
+        self.fp.write(entry + b'\n')
+
+
+class ZstdJSONHandler(FileHandler):
+    """Writes entries to a Zstandard-compressed JSON file.
+
+    Zstandard compresses considerably faster than zlib at similar ratios.
+    Unlike :class:`GzipJSONHandler` the file isn't guaranteed to be
+    readable after a crash, and entries are only written to disk once
+    enough data has been compressed or the handler is closed.
+
+    Requires the `zstandard`_ package.
+
+    Parameters
+    ----------
+    filename : str
+        The filename (including the `.zst` extension) to save the
+        compressed log to.
+    level : int, optional
+        The Zstandard compression level. Defaults to 3.
+    threads : int, optional
+        The number of threads to compress with, where -1 means one per
+        CPU. Defaults to 0, which compresses in the calling thread.
+
+    .. _zstandard: https://github.com/indygreg/python-zstandard
+
+    """
+    JSON = True
+
+    def __init__(self, filename, level=3, threads=0, **kwargs):
+        super(ZstdJSONHandler, self).__init__(**kwargs)
+        if zstandard is None:
+            raise ImportError('ZstdJSONHandler requires zstandard')
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+        self.fp = compressor.stream_writer(io.open(filename, 'wb'))
 
     def log(self, entry):
-        self.fp.write(entry + '\n')
+        self.fp.write(entry + b'\n')
 
 
 class ServerHandler(Handler):
     """Streams updates over TCP.
 
+    Entries are handed to a publisher thread, which sends them to clients
+    in batches. This keeps socket operations off the caller's thread.
+
     Parameters
     ----------
     port : int, optional
         The port over which log entries will be published. Defaults to
         5557.
+    hwm : int, optional
+        The maximum number of entries queued for each client, after which
+        new entries are dropped for that client. Defaults to 100000.
+    batch_size : int, optional
+        The number of entries after which the publisher thread is woken up
+        immediately. Defaults to 64.
+    linger : float, optional
+        The maximum number of seconds the publisher thread waits for a
+        batch to fill up. Defaults to 0.005.
 
     """
     JSON = True
 
     # http://zguide.zeromq.org/py:clonesrv1
-    def __init__(self, port=5557, **kwargs):
+    def __init__(self, port=5557, hwm=100000, batch_size=64, linger=0.005,
+                 **kwargs):
         super(ServerHandler, self).__init__(**kwargs)
-        self.ctx = zmq.Context()
+        # Share the process-wide context and its I/O thread
+        self.ctx = zmq.Context.instance()
         self.sequence = 0
         self.publisher = self.ctx.socket(zmq.PUB)
+        # Allow bursts of log entries to be queued instead of dropped
+        self.publisher.sndhwm = hwm
+        self.publisher.sndbuf = 1 << 22
         self.publisher.bind('tcp://*:{}'.format(port))
         # No sleep means clients join late and miss the first few messages
-
-    def _log(self, socket, entry):
-        socket.send(str(self.sequence).encode(), zmq.SNDMORE)
-        socket.send_string(entry)
+        self.batch_size = batch_size
+        self.linger = linger
+
+        # Entries waiting to be sent by the publisher thread
+        self._pending = deque()
+        self._ready = threading.Event()
+        self._full = threading.Event()
+        # The sequence number of the last entry that was sent
+        self._sent_sequence = 0
+        self._sent = threading.Condition()
+        self._closing = False
+        self._publisher_thread = threading.Thread(target=self._publish)
+        # Daemons are shut down when main process ends
+        self._publisher_thread.daemon = True
+        self._publisher_thread.start()
+
+    def _publish(self):
+        """Send pending entries to the clients in batches."""
+        while True:
+            self._ready.wait()
+            # Give the batch some time to fill up
+            self._full.wait(self.linger)
+            self._ready.clear()
+            self._full.clear()
+            closing = self._closing
+
+            while self._pending:
+                batch = []
+                while self._pending and len(batch) < self.batch_size:
+                    batch.append(self._pending.popleft())
+                # Publish entries to all clients
+                for sequence, entry in batch:
+                    self.publisher.send_multipart([sequence, entry],
+                                                  copy=False)
+                self._published(batch)
+                with self._sent:
+                    self._sent_sequence += len(batch)
+                    self._sent.notify_all()
+
+            if closing:
+                break
+
+    def _published(self, batch):
+        """Called by the publisher thread with each batch it sent."""
+        pass
 
     def log(self, entry):
         self.sequence += 1
-        self._log(self.publisher, entry)
+        self._pending.append((b'%d' % self.sequence, entry))
+        if not self._ready.is_set():
+            self._ready.set()
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+
+    def flush(self):
+        """Block until all pending entries have been sent.
+
+        Returns immediately if the handler was closed, since closing sends
+        the pending entries already.
+
+        """
+        if self._closing:
+            return
+        sequence = self.sequence
+        self._ready.set()
+        self._full.set()
+        with self._sent:
+            while self._sent_sequence < sequence:
+                self._sent.wait()
+
+    def close(self):
+        """Send the pending entries and stop the publisher thread.
+
+        The socket is closed afterwards, which releases the port.
+
+        """
+        if not self._closing:
+            self._closing = True
+            self._ready.set()
+            self._full.set()
+            self._publisher_thread.join()
+            # The context is shared, so it isn't terminated instead
+            self.publisher.close()
 
 
 class PersistentServerHandler(ServerHandler):
-    """Publishes updates over TCP but allows clients to catch up.
+    r"""Publishes updates over TCP but allows clients to catch up.
+
+    The publisher thread stores each batch of entries it sent, and a
+    separate thread sends the stored entries to clients that request a
+    snapshot.
 
     Parameters
     ----------
@@ -183,6 +403,8 @@ class PersistentServerHandler(ServerHandler):
     maxlen : int or None, optional
         The maximum number of log entries to keep in memory i.e. the
         maximum size of the snapshot. Defaults to None.
+    \*\*kwargs
+        Passed on to :class:`ServerHandler`, e.g. `batch_size`.
 
     """
     # http://zguide.zeromq.org/py:clonesrv2
@@ -190,73 +412,115 @@ class PersistentServerHandler(ServerHandler):
 
     def __init__(self, push_port=5557, router_port=5556, maxlen=None,
                  **kwargs):
+        # The serialized sequence numbers and entries are stored in two
+        # parallel queues, which are shared with the snapshot thread
+        self._sequences = deque([], maxlen=maxlen)
+        self._entries = deque([], maxlen=maxlen)
+        self._lock = threading.Lock()
         super(PersistentServerHandler, self).__init__(port=push_port, **kwargs)
 
-        # Set up IPC and start a thread
-        self.updates, peer = zpipe(self.ctx)
-        manager_thread = threading.Thread(target=state_manager,
-                                          args=(self.ctx, peer,
-                                                router_port, maxlen))
+        # Bound here so that a port in use is reported to the caller
+        snapshot = self.ctx.socket(zmq.ROUTER)
+        try:
+            snapshot.bind('tcp://*:{}'.format(router_port))
+        except zmq.ZMQError:
+            snapshot.close()
+            super(PersistentServerHandler, self).close()
+            raise
+        # A message over this pipe stops the snapshot thread
+        endpoint = 'inproc://mimir-snapshot-{}'.format(next(_control_counter))
+        self._control = self.ctx.socket(zmq.PAIR)
+        self._control.bind(endpoint)
+        control = self.ctx.socket(zmq.PAIR)
+        control.connect(endpoint)
+        self._manager_thread = threading.Thread(
+            target=state_manager,
+            args=(snapshot, control, self._sequences, self._entries,
+                  self._lock)
+        )
         # Daemons are shut down when main process ends
-        manager_thread.daemon = True
-        manager_thread.start()
-
-    def log(self, entry):
-        self.sequence += 1
-        # Publish entry to all clients
-        self._log(self.publisher, entry)
-        # Send the entry to other thread to store
-        self._log(self.updates, entry)
+        self._manager_thread.daemon = True
+        self._manager_thread.start()
 
+    def _published(self, batch):
+        sequences, entries = zip(*batch)
+        with self._lock:
+            self._sequences.extend(sequences)
+            self._entries.extend(entries)
 
-def state_manager(ctx, pipe, port, maxlen):
-    """Stores log entries and sends them to clients upon request.
+    def close(self):
+        """Stop the publisher and snapshot threads and close the sockets."""
+        closing = self._closing
+        super(PersistentServerHandler, self).close()
+        if not closing:
+            try:
+                self._control.send(b'', zmq.NOBLOCK)
+            except zmq.Again:
+                # The snapshot thread already stopped
+                pass
+            self._manager_thread.join()
+            self._control.close()
+
+
+def state_manager(snapshot, control, sequences, entries, lock,
+                  chunk_size=1024):
+    """Sends the stored log entries to clients upon request.
+
+    The serialized sequence numbers and entries are sent as-is, so they
+    are never decoded or copied in Python. Both sockets are closed when
+    this function returns.
 
     Parameters
     ----------
-    ctx : :class:`zmq.Context` instance
-        The ZMQ context used to create the ROUTER socket on which requests
-        for snapshots will be listened and replied to.
-    pipe : :class:`zmq.Socket` instance
-        A PAIR socket used to receive log entries from the main thread.
-    port : int
-        The port to bind the ROUTER socket to.
-    maxlen : int or None
-        The maximum number of entries to keep in memory.
+    snapshot : :class:`zmq.Socket`
+        The bound ROUTER socket on which requests for snapshots will be
+        listened and replied to.
+    control : :class:`zmq.Socket`
+        A PAIR socket. Receiving any message on it stops this function.
+    sequences : :class:`collections.deque`
+        The serialized sequence numbers of the stored entries.
+    entries : :class:`collections.deque`
+        The serialized entries, in the same order as `sequences`.
+    lock : :class:`threading.Lock`
+        The lock held while `sequences` and `entries` are changed.
+    chunk_size : int, optional
+        The maximum number of entries sent per message of a snapshot.
+        Defaults to 1024.
 
     """
-    store = deque([], maxlen=maxlen)
-
-    # Create socket through which snapshots can be sent
-    snapshot = ctx.socket(zmq.ROUTER)
-    snapshot.bind('tcp://*:{}'.format(port))
-
-    # Listen for both updates from main thread, and requests for snapshots
     poller = zmq.Poller()
-    poller.register(pipe, zmq.POLLIN)
     poller.register(snapshot, zmq.POLLIN)
+    poller.register(control, zmq.POLLIN)
+    try:
+        while True:
+            try:
+                events = dict(poller.poll())
+            except (zmq.ZMQError, KeyboardInterrupt):
+                break
+            if control in events:
+                break
 
-    while True:
-        try:
-            items = dict(poller.poll())
-        except (zmq.ZMQError, KeyboardInterrupt):
-            break
-
-        if pipe in items:
-            sequence, entry = int(pipe.recv()), pipe.recv_string()
-            store.append((sequence, entry))
-        if snapshot in items:
             # A client asked for a snapshot
             # NB: client is needed to route messages
             # http://zeromq.org/tutorials:dealer-and-router
             client, request = snapshot.recv_multipart()
             assert request == b'ICANHAZ?'
 
-            # Send all the entries to the client
-            for k, v in store:
-                snapshot.send(client, zmq.SNDMORE)
-                snapshot.send(str(k).encode(), zmq.SNDMORE)
-                snapshot.send_string(v)
+            # Only hold the lock long enough to copy the store
+            with lock:
+                snapshot_sequences = list(sequences)
+                snapshot_entries = list(entries)
+
+            # Send all the entries to the client, many per message
+            for i in range(0, len(snapshot_entries), chunk_size):
+                chunk_sequences = snapshot_sequences[i:i + chunk_size]
+                frames = [client] * (2 * len(chunk_sequences) + 1)
+                frames[1::2] = chunk_sequences
+                frames[2::2] = snapshot_entries[i:i + chunk_size]
+                snapshot.send_multipart(frames, copy=False)
 
             # Sending a sequence number < 0 means end of snapshot
-            snapshot.send_multipart([client, b'-1', b'""'])
+            snapshot.send_multipart([client, b'-1', b'{}'], copy=False)
+    finally:
+        snapshot.close()
+        control.close()
@@ -1,19 +1,34 @@
 """The logger object and user-friendly interface for constructing it."""
 import io
 import os
-from collections import deque, Sequence
+import threading
+import traceback
+import weakref
+from collections import deque
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+try:
+    from queue import SimpleQueue
+except ImportError:
+    from six.moves.queue import Queue as SimpleQueue
 
-import simplejson as json
+import numpy
+import six
 
 from . import utils
 from .formatters import simple_formatter
-from .serialization import serialize_numpy, loads
-from .handlers import (GzipJSONHandler, JSONHandler, PrintHandler,
-                       PersistentServerHandler, ServerHandler)
+from .serialization import (cache_fragments, get_dumps, get_loads,
+                            serialize_numpy)
+from .handlers import (GzipJSONHandler, Handler, JSONHandler, PrintHandler,
+                       PersistentServerHandler, ServerHandler,
+                       ZstdJSONHandler)
 
 
 def Logger(filename=None, maxlen=0, stream=False, stream_maxlen=0,
            formatter=simple_formatter, push_port=5557, router_port=5556,
+           compresslevel=1, cache_keys=None, background=False, schema=None,
            **kwargs):
     r"""A pseudo-class for easy initialization of a log.
 
@@ -28,7 +43,9 @@ def Logger(filename=None, maxlen=0, stream=False, stream_maxlen=0,
     ----------
     filename : str, optional
         The file to save the log to in newline delimited JSON format. If
-        the filename ends in `.gz` it will be compressed on the fly.
+        the filename ends in `.gz` it will be compressed on the fly. If it
+        ends in `.zst` it will be compressed using Zstandard instead, which
+        requires the `zstandard` package.
     maxlen : int or None, optional
         The number of entries to store for later retrieval. By default this
         is 0 i.e. entries are discarded after being fed to the handlers.
@@ -53,9 +70,30 @@ def Logger(filename=None, maxlen=0, stream=False, stream_maxlen=0,
     router_port : int, optional
         The port over which snapshots will be sent if `stream_maxlen > 0`.
         Defaults to 5556.
+    compresslevel : int, optional
+        The compression level used if the log is gzipped, from 0 to 9.
+        Defaults to 1, the fastest.
+    cache_keys : iterable, optional
+        Top-level keys whose values rarely change between entries (e.g.
+        hyperparameters). Their serialized form is cached and reused as
+        long as the value stays the same. See :func:`cache_fragments`.
+    background : bool, optional
+        If `True`, entries are passed to the handlers by a background
+        thread, so that writing files and sending messages doesn't block
+        the caller. Entries shouldn't be modified after being logged in
+        this case. Defaults to `False`.
+    schema : dict, optional
+        If given, the stored entries are kept in NumPy arrays instead of as
+        dictionaries, which takes far less memory. Maps each key to the
+        dtype of its values. Every entry must contain these keys, and
+        other keys aren't stored. See :meth:`_Logger.column`.
     \*\*kwargs
         Keyword arguments passed on to ``json.dumps``. By default
         ``ensure_ascii=False`` and ``default=serialize_numpy`` are passed.
+        If `orjson` is installed and no other arguments are given, it is
+        used instead for faster serialization. Entries with ``NaN`` or
+        infinity, named tuples or integers wider than 64 bits are still
+        serialized by ``json.dumps``, see :func:`get_dumps`.
 
     Returns
     -------
@@ -68,9 +106,12 @@ def Logger(filename=None, maxlen=0, stream=False, stream_maxlen=0,
         root, ext = os.path.splitext(filename)
         # If the file ends in .gz then gzip it
         if ext == '.gz':
-            handlers.append(GzipJSONHandler(root))
+            handlers.append(GzipJSONHandler(root, compresslevel=compresslevel))
+        elif ext == '.zst':
+            handlers.append(ZstdJSONHandler(filename))
         else:
-            handlers.append(JSONHandler(io.open(filename, 'w')))
+            fp = io.open(filename, 'wb', buffering=1 << 20)
+            handlers.append(JSONHandler(fp))
     if formatter:
         handlers.append(PrintHandler(formatter))
     if stream:
@@ -81,7 +122,40 @@ def Logger(filename=None, maxlen=0, stream=False, stream_maxlen=0,
             ))
         else:
             handlers.append(ServerHandler(port=push_port))
-    return _Logger(handlers, maxlen=maxlen, **kwargs)
+    return _Logger(handlers, maxlen=maxlen, cache_keys=cache_keys,
+                   background=background, schema=schema, **kwargs)
+
+
+class _HandlerList(list):
+    """A list of handlers that updates its logger whenever it is modified.
+
+    Only a weak reference to the logger is kept so that loggers can still
+    be cleaned up (and their files closed) by reference counting.
+
+    """
+    def __init__(self, handlers, logger):
+        super(_HandlerList, self).__init__(handlers)
+        self._logger = weakref.ref(logger)
+
+
+def _notifying(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        logger = self._logger()
+        if logger is not None:
+            logger._plan_handlers()
+        return result
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__',
+              '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop',
+              'remove', 'clear', 'reverse', 'sort'):
+    if hasattr(list, _name):
+        setattr(_HandlerList, _name, _notifying(_name))
 
 
 class _Logger(Sequence):
@@ -94,6 +168,12 @@ class _Logger(Sequence):
         the given order. If `None`, the log entry will simply be ignored.
     maxlen : int or None, optional
         See :func:`Logger`'s `maxlen` argument.
+    cache_keys : iterable, optional
+        See :func:`Logger`'s `cache_keys` argument.
+    background : bool, optional
+        See :func:`Logger`'s `background` argument.
+    schema : dict, optional
+        See :func:`Logger`'s `schema` argument.
     \*\*kwargs
         Keyword arguments passed on to ``json.dumps``. By default
         ``ensure_ascii=False`` and ``default=serialize_numpy`` are passed.
@@ -102,18 +182,138 @@ class _Logger(Sequence):
     ----------
     handlers : list
         The list of handlers, which can be appended to and removed from as
-        needed.
+        needed. Assigning new filters or a new predicate to one of the
+        handlers updates the logger as well.
+    log : callable
+        Logs an entry. This is a function generated for the current
+        handlers and assigned to the instance whenever they change, so a
+        subclass can't override `log` by defining a method.
 
     """
-    def __init__(self, handlers=None, maxlen=0, **kwargs):
+    def __init__(self, handlers=None, maxlen=0, cache_keys=None,
+                 background=False, schema=None, **kwargs):
         if not handlers:
             handlers = []
-        self.handlers = handlers
-        self._entries = deque([], maxlen=maxlen)
+        if schema:
+            self._entries = _ColumnStore(schema, maxlen=maxlen)
+        else:
+            self._entries = deque([], maxlen=maxlen)
         # Ensure that json.dumps returns UTF-8 strings on Python 2
         kwargs.setdefault('ensure_ascii', False)
         kwargs.setdefault('default', serialize_numpy)
         self.json_kwargs = kwargs
+        self._dumps = get_dumps(**kwargs)
+        if cache_keys:
+            self._dumps = cache_fragments(self._dumps, cache_keys)
+        self._queue = None
+        if background:
+            self._queue = SimpleQueue()
+            self._worker = threading.Thread(target=_drain, args=(self._queue,))
+            self._worker.daemon = True
+            self._worker.start()
+        self.handlers = handlers
+
+    @property
+    def handlers(self):
+        return self._handlers
+
+    @handlers.setter
+    def handlers(self, handlers):
+        self._handlers = _HandlerList(handlers, self)
+        self._plan_handlers()
+
+    def _plan_handlers(self):
+        """Precompute the per-handler state needed by :meth:`log`."""
+        for handler in self._handlers:
+            handler._loggers.add(self)
+        self._plan = [(handler._filters_key, handler.predicate,
+                       handler.JSON, _get_filter(handler), handler.log)
+                      for handler in self._handlers]
+        self.log = self._compile_log()
+
+    def _compile_log(self):
+        """Generate a version of :meth:`log` specialized to the handlers.
+
+        The generated function calls the handlers in order without any
+        loops or dictionary lookups. Each distinct set of filters is
+        applied at most once, and the filtered entry is serialized at most
+        once, lazily if predicates might skip the handlers needing it.
+
+        When logging in the background, the handlers are called by a
+        separate function which is queued together with the entry. Entries
+        aren't stored at all if `maxlen` is 0.
+
+        """
+        namespace = {'append': self._entries.append, 'dumps': self._dumps}
+        filter_sets = {}
+        body = []
+        # Variables that have definitely and possibly been computed
+        computed, maybe_computed = set(), set()
+
+        def compute(name, expr, indent, conditional):
+            if name in computed:
+                return
+            if name in maybe_computed:
+                body.append('{}if {} is None:'.format(indent, name))
+                body.append('{}    {} = {}'.format(indent, name, expr))
+            else:
+                body.append('{}{} = {}'.format(indent, name, expr))
+            if conditional:
+                maybe_computed.add(name)
+            else:
+                computed.add(name)
+
+        for i, (filters, predicate, wants_json, filter_,
+                log) in enumerate(self._plan):
+            indent = '    '
+            if predicate is not None:
+                namespace['p{}'.format(i)] = predicate
+                body.append('    if p{}(entry):'.format(i))
+                indent = '        '
+            conditional = predicate is not None
+
+            k = filter_sets.setdefault(filters, len(filter_sets))
+            arg = 'entry'
+            if filters:
+                # The first handler to need the filtered entry computes it
+                # with its own filter, which might be overridden
+                namespace['f{}'.format(i)] = filter_
+                arg = 'e{}'.format(k)
+                compute(arg, 'f{}(entry)'.format(i), indent, conditional)
+            if wants_json:
+                compute('s{}'.format(k), 'dumps({})'.format(arg), indent,
+                        conditional)
+                arg = 's{}'.format(k)
+
+            namespace['log{}'.format(i)] = log
+            body.append('{}log{}({})'.format(indent, i, arg))
+
+        # A deque with maxlen 0 discards entries straight away
+        store = 'pass' if self._entries.maxlen == 0 else 'append(entry)'
+        if self._queue is None:
+            lines = ['def log(entry):', '    ' + store]
+        else:
+            lines = ['def dispatch(entry):', '    pass']
+        lines.extend('    {} = None'.format(name)
+                     for name in sorted(maybe_computed))
+        lines.extend(body)
+        exec('\n'.join(lines), namespace)
+        # Remove the function from its own globals to avoid a reference
+        # cycle, which would delay closing the handlers' files
+        if self._queue is not None:
+            namespace = {'append': self._entries.append,
+                         'put': self._queue.put,
+                         'dispatch': namespace.pop('dispatch')}
+            exec('def log(entry):\n'
+                 '    {}\n'
+                 '    put((dispatch, entry))'.format(store), namespace)
+        log = namespace.pop('log')
+        log.__doc__ = _LOG_DOC
+        return log
+
+    def add_handler(self, handler):
+        """Add a handler to the end of the list of handlers."""
+        self.handlers.append(handler)
 
     def __enter__(self):
         return self
@@ -127,8 +327,27 @@ class _Logger(Sequence):
     def __len__(self):
         return len(self._entries)
 
+    def column(self, key):
+        """Return the stored values of a key as a NumPy array.
+
+        Only supported if a schema was given. The array shouldn't be
+        modified, since it can be a view of the stored values.
+
+        """
+        if not isinstance(self._entries, _ColumnStore):
+            raise ValueError('columns require a schema')
+        return self._entries.column(key)
+
     def close(self):
-        """Close the handlers."""
+        """Close the handlers.
+
+        When logging in the background, this first waits for all the
+        queued entries to be handled.
+
+        """
+        if self._queue is not None and self._worker.is_alive():
+            self._queue.put(None)
+            self._worker.join()
         for handler in self.handlers:
             handler.close()
 
@@ -139,7 +358,8 @@ class _Logger(Sequence):
         ----------
         filename : str
             The file to load from. If it ends in ``.gz`` it's assumed to be
-            a gzipped file.
+            a gzipped file, and if it ends in ``.zst`` a Zstandard
+            compressed one.
         \*\*kwargs
             Arguments passed on ``json.loads``, useful for deserializing
             non-basic objects. By default ``deserialize_numpy`` is passed.
@@ -150,55 +370,133 @@ class _Logger(Sequence):
             The number of log entries in the file.
 
         """
-        entries = deque([], maxlen=self._entries.maxlen)
-
-        num_entries = 0
-        with utils.open(filename, raw_text=True) as f:
+        loads = get_loads(**kwargs)
+        maxlen = self._entries.maxlen
+        with utils.open_binary(filename) as f:
+            if maxlen is None:
+                # Every entry is kept, so deserialize them straight away
+                # instead of holding on to the raw lines as well
+                num_entries = len(self._entries)
+                self._entries.extend(map(loads, f))
+                return len(self._entries) - num_entries
+            # Only the entries that will be kept are deserialized
+            entries = deque([], maxlen=maxlen)
+            num_entries = 0
             for entry in f:
                 num_entries += 1
                 entries.append(entry)
-        for entry in entries:
-            self._entries.append(loads(entry, **kwargs))
+        self._entries.extend(map(loads, entries))
         return num_entries
 
-    def log(self, entry):
-        """Log an entry.
 
-        Will check if the handler contains filters and apply them if needed
-        (so that if multiple handlers have the same filters, they are only
-        applied once). Likewise, it will check if the log entry needs to be
-        serialized to JSON data, and make sure that the data is only
-        serialized once for each set of filters.
+# The docstring of the log functions generated by _Logger._compile_log
+_LOG_DOC = """Log an entry.
 
-        Parameters
-        ----------
-        entry : dict
-            A log entry is a (JSON-compatible) dict.
+The entry is stored, and passed to each handler whose predicate accepts
+it. Each distinct set of filters is applied at most once, and the filtered
+entry is serialized to JSON at most once for the handlers that want it.
 
-        """
-        # Store entry for retrieval
-        self._entries.append(entry)
+Parameters
+----------
+entry : dict
+    A log entry is a (JSON-compatible) dict.
 
-        # For each set of filters, we store the JSON serialized entry
-        filtered_entries = {}
-        serialized_entries = {}
-        for handler in self.handlers:
-            filters = frozenset(handler.filters)
+"""
 
-            # If the content needs to be filtered, do so
-            if filters:
-                if filters not in filtered_entries:
-                    filtered_entries[filters] = handler.filter(entry)
-                filtered_entry = filtered_entries[filters]
-            else:
-                filtered_entry = entry
-
-            # If the handler wants JSON data, give it
-            if handler.JSON:
-                if filters not in serialized_entries:
-                    serialized_entries[filters] = json.dumps(
-                        filtered_entry, **self.json_kwargs)
-                serialized_entry = serialized_entries[filters]
-                handler.log(serialized_entry)
-            else:
-                handler.log(filtered_entry)
+
+class _ColumnStore(object):
+    """Stores entries with a fixed schema in a NumPy array per key.
+
+    Behaves like the subset of :class:`collections.deque` used by
+    :class:`_Logger`. With a `maxlen` the arrays are used as ring buffers,
+    otherwise they are doubled in size whenever they are full.
+
+    Parameters
+    ----------
+    schema : dict
+        Maps each key to the dtype of its values.
+    maxlen : int or None, optional
+        The maximum number of entries to store, or `None` for unlimited
+        memory.
+
+    """
+    def __init__(self, schema, maxlen=None):
+        self.maxlen = maxlen
+        capacity = 1024 if maxlen is None else maxlen
+        self._columns = [(key, numpy.empty(capacity, dtype=dtype))
+                         for key, dtype in schema.items()]
+        self._capacity = capacity
+        # The index of the oldest entry and the number of entries
+        self._start = 0
+        self._len = 0
+
+    def _grow(self):
+        self._capacity *= 2
+        columns = []
+        for key, column in self._columns:
+            grown = numpy.empty(self._capacity, dtype=column.dtype)
+            grown[:self._len] = column
+            columns.append((key, grown))
+        self._columns = columns
+
+    def append(self, entry):
+        if self._len == self._capacity:
+            if self.maxlen is None:
+                self._grow()
+            elif not self.maxlen:
+                return
+        i = (self._start + self._len) % self._capacity
+        for key, column in self._columns:
+            column[i] = entry[key]
+        if self._len < self._capacity:
+            self._len += 1
+        else:
+            # The oldest entry was overwritten
+            self._start = (self._start + 1) % self._capacity
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('index out of range')
+        i = (self._start + index) % self._capacity
+        return dict((key, column[i].item()) for key, column in self._columns)
+
+    def column(self, key):
+        column = dict(self._columns)[key]
+        if self._start == 0:
+            return column[:self._len]
+        return numpy.concatenate((column[self._start:],
+                                  column[:self._start]))
+
+
+def _get_filter(handler):
+    """Return the handler's generated filter chain unless overridden."""
+    if (six.get_unbound_function(type(handler).filter) is
+            six.get_unbound_function(Handler.filter)):
+        return handler._filter_chain
+    return handler.filter
+
+
+def _drain(queue):
+    """Pass queued entries to the handlers until `None` is received."""
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        dispatch, entry = item
+        try:
+            dispatch(entry)
+        except Exception:
+            # Like the logging module, report errors instead of losing the
+            # thread and with it all subsequent entries
+            traceback.print_exc()
+        # Don't keep the handlers alive while waiting for the next entry
+        del item, dispatch, entry
@@ -48,7 +48,7 @@ def get_socket(x_key, y_key, host='localhost', push_port=5557,
         See `x`.
 
     """
-    ctx = zmq.Context()
+    ctx = zmq.Context.instance()
     subscriber = connect(host=host, port=push_port, ctx=ctx)
 
     sequence = 0
@@ -56,16 +56,19 @@ def get_socket(x_key, y_key, host='localhost', push_port=5557,
 
     if persistent:
         sequence, entries = get_snapshot(port=router_port, ctx=ctx, **kwargs)
-        for entry in entries:
-            if x_key in entry and y_key in entry:
-                x.append(entry[x_key])
-                y.append(entry[y_key])
+        entries = [entry for entry in entries
+                   if x_key in entry and y_key in entry]
+        x = [entry[x_key] for entry in entries]
+        y = [entry[y_key] for entry in entries]
 
     return subscriber, sequence, x, y
 
 
-def update(x_key, y_key, init_sequence, subscriber, plot):
-    """Add a data point to a given plot.
+def update(x_key, y_key, init_sequence, subscriber, plot, max_batch=1024):
+    """Add data points to a given plot.
+
+    Waits for an entry, after which the entries that have already arrived
+    (up to `max_batch` of them) are added to the plot in a single update.
 
     Parameters
     ----------
@@ -82,14 +85,23 @@ def update(x_key, y_key, init_sequence, subscriber, plot):
         The ZMQ socket to receive the sequence number and JSON data over.
     plot : Bokeh plot
         The Bokeh plot whose data source will be updated.
+    max_batch : int, optional
+        The maximum number of entries to receive in a single update, so
+        that a fast logger can't keep this function from returning. The
+        remaining entries are received by the next call. Defaults to 1024.
 
     """
-    sequence, entry = recv(subscriber)
-    if sequence > init_sequence and x_key in entry and y_key in entry:
-        # Mutating data source in place doesn't work
-        x = plot.data_source.data['x'] + [entry[x_key]]
-        y = plot.data_source.data['y'] + [entry[y_key]]
-        plot.data_source.data = dict(x=x, y=y)
+    x, y = [], []
+    for _ in range(max_batch):
+        sequence, entry = recv(subscriber)
+        if sequence > init_sequence and x_key in entry and y_key in entry:
+            x.append(entry[x_key])
+            y.append(entry[y_key])
+        if not subscriber.poll(0):
+            break
+    if x:
+        # Only the new points are sent instead of the whole series
+        plot.data_source.stream(dict(x=x, y=y))
 
 
 def serve_plot(x_key, y_key, **kwargs):
@@ -1,15 +1,29 @@
+import os
+import tempfile
 import threading
+try:
+    from queue import SimpleQueue
+except ImportError:
+    from six.moves.queue import Queue as SimpleQueue
 
-import simplejson as json
 import zmq
 
-from .logger import Logger
-from .serialization import loads, serialize_numpy
+from .logger import Logger, _drain
+from .serialization import (deserialize_numpy, deserialize_numpy_frames,
+                            get_dumps, get_loads, serialize_numpy_frames)
 
 LOG_READY = b"\x01"
 LOG_ACK = b"\x02"
 LOG_DONE = b"\x03"
 
+# Hosts for which a Unix domain socket can be used instead of TCP
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+
+def _ipc_path(port):
+    """The path of the Unix domain socket of the server on this port."""
+    return os.path.join(tempfile.gettempdir(), 'mimir-{}.ipc'.format(port))
+
 
 def _server_logger(port, loads_kwargs, *args, **kwargs):
     """Start a server logger.
@@ -18,39 +32,60 @@ def _server_logger(port, loads_kwargs, *args, **kwargs):
     thread.
 
     """
+    ipc = kwargs.pop('ipc', False)
     logger = Logger(*args, **kwargs)
+    loads_kwargs = dict(loads_kwargs or {})
+    loads = get_loads(**loads_kwargs)
+    object_hook = loads_kwargs.pop('object_hook', deserialize_numpy)
 
-    ctx = zmq.Context()
+    ctx = zmq.Context.instance()
     remote_logs = ctx.socket(zmq.ROUTER)
     remote_logs.bind('tcp://*:{}'.format(port))
+    if ipc:
+        remote_logs.bind('ipc://{}'.format(_ipc_path(port)))
 
-    # Wait for the first client to connect
-    client_id = 1
-    clients = {}
-    msg = remote_logs.recv_multipart()
-    client, request = msg[0], msg[2]
-    assert request == LOG_READY
-    clients[client] = msg[3].decode() or client_id
-    remote_logs.send_multipart([client, b'', LOG_READY])
-
-    while clients:
+    try:
+        # Wait for the first client to connect
+        client_id = 1
+        clients = {}
         msg = remote_logs.recv_multipart()
         client, request = msg[0], msg[2]
-        if request == LOG_READY:
-            assert client not in clients
-            client_id += 1
-            clients[client] = msg[3].decode() or client_id
-            remote_logs.send_multipart([client, b'', LOG_READY])
-        elif request == LOG_DONE:
-            assert client in clients
-            del clients[client]
-            remote_logs.send_multipart([client, b'', LOG_DONE])
-        else:
-            assert client in clients
-            entry = loads(request.decode(), **(loads_kwargs or {}))
-            entry['remote_log'] = clients[client]
-            logger.log(entry)
-            remote_logs.send_multipart([client, b'', LOG_ACK])
+        assert request == LOG_READY
+        clients[client] = msg[3].decode() or client_id
+        remote_logs.send_multipart([client, b'', LOG_READY])
+
+        while clients:
+            msg = remote_logs.recv_multipart()
+            client, request = msg[0], msg[2]
+            if request == LOG_READY:
+                assert client not in clients
+                client_id += 1
+                clients[client] = msg[3].decode() or client_id
+                remote_logs.send_multipart([client, b'', LOG_READY])
+            elif request == LOG_DONE:
+                assert client in clients
+                del clients[client]
+                remote_logs.send_multipart([client, b'', LOG_DONE])
+            else:
+                # Entries from unknown clients fail when looking up their name
+                if len(msg) > 3:
+                    # NumPy arrays were sent as separate frames
+                    entry = get_loads(object_hook=deserialize_numpy_frames(
+                        msg[3:], object_hook), **loads_kwargs)(request)
+                else:
+                    entry = loads(request)
+                entry['remote_log'] = clients[client]
+                logger.log(entry)
+                remote_logs.send_multipart([client, b'', LOG_ACK])
+    finally:
+        # The context is shared, so the port is only released by closing
+        remote_logs.close()
+        if ipc:
+            # Stop remote loggers from connecting to a stale socket file
+            try:
+                os.remove(_ipc_path(port))
+            except OSError:
+                pass
     return logger
 
 
@@ -81,6 +116,12 @@ def ServerLogger(port=5555, loads_kwargs=None, threaded=False, *args,
         started in another thread. Note that this thread is not a daemon,
         so the Python process will be kept alive until all remote loggers
         have terminated.
+    ipc : bool, optional
+        If true, the server logger also listens on a Unix domain socket,
+        which remote loggers on the same machine can use instead of TCP
+        (see :class:`RemoteLogger`). The socket file is removed when the
+        server logger closes. Defaults to `False`. Only supported on POSIX
+        systems.
     \*args
         All other arguments are the same as those of the :func:`Logger`
         constructor.
@@ -110,6 +151,10 @@ def ServerLogger(port=5555, loads_kwargs=None, threaded=False, *args,
 class RemoteLogger(object):
     """A remote logger, which sends its log entries to a server to process.
 
+    Entries are sent without waiting for the server to acknowledge them,
+    as long as fewer than `window` entries are unacknowledged. Hence the
+    logger's throughput isn't limited by the round-trip time.
+
     Parameters
     ----------
     name : str, optional
@@ -120,35 +165,94 @@ class RemoteLogger(object):
     port : int, optional
         The port to connect to. Defaults to 5555.
     ctx : :class:`zmq.Context`, optional
-        The ZMQ context to use. If not given, one will be created.
+        The ZMQ context to use. If not given, the process-wide instance
+        is used.
+    window : int, optional
+        The maximum number of entries that can be sent before the server
+        acknowledged them. Defaults to 64.
+    background : bool, optional
+        If `True`, entries are serialized and sent by a background thread,
+        so that the caller is never blocked by the network. Entries
+        shouldn't be modified after being logged in this case. Defaults to
+        `False`.
+    ipc : bool, optional
+        If true and the host is local, connect to the Unix domain socket
+        of a server logger started with ``ipc=True`` instead of using TCP.
+        Defaults to `False`.
     \*\*kwargs
         All other keyword arguments will be passed on to ``json.dumps``.
+        If `orjson` is installed and no other arguments are given, it is
+        used instead for faster serialization. Unless a `default` function
+        is given, the data of NumPy arrays is sent as separate message
+        frames instead of being encoded as base64.
 
     """
     def __init__(self, name=None, host='localhost', port=5555, ctx=None,
-                 **kwargs):
+                 window=64, background=False, ipc=False, **kwargs):
         # Connect to server log
         self.closed = True
         if not ctx:
-            ctx = zmq.Context()
-        server_log = ctx.socket(zmq.REQ)
-        server_log.connect('tcp://{}:{}'.format(host, port))
+            ctx = zmq.Context.instance()
+        # A DEALER socket can send requests without waiting for replies. The
+        # empty delimiter frame of a REQ socket is added by hand.
+        server_log = ctx.socket(zmq.DEALER)
+        if ipc and host in LOCAL_HOSTS and zmq.has('ipc'):
+            server_log.connect('ipc://{}'.format(_ipc_path(port)))
+        else:
+            server_log.connect('tcp://{}:{}'.format(host, port))
         self.server_log = server_log
+        self.window = window
+        self._pending = 0
 
         # Handshake with server
-        server_log.send_multipart([LOG_READY, name.encode() if name else b''])
-        assert server_log.recv() == LOG_READY
+        server_log.send_multipart([b'', LOG_READY,
+                                   name.encode() if name else b''])
+        assert self._recv() == LOG_READY
         self.closed = False
 
         # JSON serialization
         kwargs.setdefault('ensure_ascii', False)
-        kwargs.setdefault('default', serialize_numpy)
+        # Arrays serialized by the default function are collected here
+        self._frames = []
+        kwargs.setdefault('default', serialize_numpy_frames(self._frames))
         self.json_kwargs = kwargs
+        self._dumps = get_dumps(**kwargs)
+
+        # The socket is only used by the background thread until closing
+        self._queue = None
+        if background:
+            self._queue = SimpleQueue()
+            self._worker = threading.Thread(target=_drain, args=(self._queue,))
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _recv(self):
+        """Receive a reply from the server logger."""
+        return self.server_log.recv_multipart()[1]
 
     def log(self, entry):
         """Serialize the log entry and send it to the server logger."""
-        self.server_log.send_string(json.dumps(entry, **self.json_kwargs))
-        assert self.server_log.recv() == LOG_ACK
+        if self._queue is not None:
+            self._queue.put((self._send, entry))
+        else:
+            self._send(entry)
+
+    def _send(self, entry):
+        frames = self._frames
+        del frames[:]
+        payload = self._dumps(entry)
+        if self._pending >= self.window:
+            # Only acknowledgements are sent until closing
+            self._recv()
+            self._pending -= 1
+        if frames:
+            # The arrays are copied, since they could be changed by the
+            # caller before being sent
+            self.server_log.send_multipart([b'', payload] + frames)
+            del frames[:]
+        else:
+            self.server_log.send_multipart([b'', payload], copy=False)
+        self._pending += 1
 
     def __enter__(self):
         return self
@@ -161,12 +265,22 @@ class RemoteLogger(object):
 
         Closing the connection consists of sending a termination signal to
         the server logger, and waiting for an acknowledgement of this
-        signal from the server.
+        signal from the server. The server has then handled all entries.
+
+        When logging in the background, this first waits for all the
+        queued entries to be sent.
 
         """
         if not self.closed:
-            self.server_log.send(LOG_DONE)
-            assert self.server_log.recv() == LOG_DONE
+            if self._queue is not None and self._worker.is_alive():
+                self._queue.put(None)
+                self._worker.join()
+            self.server_log.send_multipart([b'', LOG_DONE])
+            while self._pending:
+                assert self._recv() == LOG_ACK
+                self._pending -= 1
+            assert self._recv() == LOG_DONE
+            self.server_log.close()
             self.closed = True
 
     def __del__(self):
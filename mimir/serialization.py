@@ -1,9 +1,19 @@
 import base64
+import copy
 
 import numpy
 import simplejson as json
 from numpy.lib.format import header_data_from_array_1_0
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Serialized arrays contain this key, see deserialize_numpy
+_NDARRAY_MARKER = b'__ndarray__'
+
 
 def serialize_numpy(obj):
     """Serializes NumPy arrays and scalars.
@@ -17,30 +27,451 @@ def serialize_numpy(obj):
             (isinstance(obj, numpy.ndarray) and obj.ndim == 0)):
         return obj.item()
     if isinstance(obj, numpy.ndarray):
-        if not obj.flags.c_contiguous:
-            obj = numpy.ascontiguousarray(obj)
-        dct = header_data_from_array_1_0(obj)
-        data = base64.b64encode(obj.data)
+        obj = _contiguous(obj)
+        dct = _header(obj)
+        data = base64.b64encode(_c_order(obj)).decode('ascii')
         dct['__ndarray__'] = data
         return dct
     raise TypeError
 
 
+# The headers of recently serialized arrays, which are usually the same
+_HEADERS = {}
+_MAX_HEADERS = 128
+
+
+def _header(obj):
+    """Return a copy of the array's header, reusing recent ones."""
+    key = (obj.dtype, obj.shape, obj.flags.c_contiguous)
+    header = _HEADERS.get(key)
+    if header is None:
+        if len(_HEADERS) >= _MAX_HEADERS:
+            _HEADERS.clear()
+        header = _HEADERS[key] = header_data_from_array_1_0(obj)
+    return header.copy()
+
+
+def _contiguous(obj):
+    """Copy the array into C order unless it's C or Fortran contiguous."""
+    if obj.flags.c_contiguous or obj.flags.f_contiguous:
+        return obj
+    return numpy.ascontiguousarray(obj)
+
+
+def _c_order(obj):
+    """Return a C contiguous view of the data of a contiguous array.
+
+    The data of a Fortran contiguous array is the data of its transpose
+    in C order, so it doesn't need to be copied.
+
+    """
+    if obj.flags.c_contiguous:
+        return obj
+    return obj.T
+
+
+def _from_buffer(data, dct):
+    """Create an array from its data and the serialized header."""
+    obj = numpy.frombuffer(data, dtype=dct['descr'])
+    if dct['fortran_order']:
+        obj.shape = dct['shape'][::-1]
+        return obj.transpose()
+    obj.shape = dct['shape']
+    return obj
+
+
 def deserialize_numpy(dct):
     """Deserialize NumPy arrays encoded as base64 data."""
     if '__ndarray__' in dct:
-        data = base64.b64decode(dct['__ndarray__'])
-        obj = numpy.frombuffer(data, dtype=dct['descr'])
-        if dct['fortran_order']:
-            obj.shape = dct['shape'][::-1]
-            obj = obj.transpose()
-        else:
-            obj.shape = dct['shape']
-        return obj
+        return _from_buffer(base64.b64decode(dct['__ndarray__']), dct)
     return dct
 
 
+def serialize_numpy_frames(frames):
+    """Create a function that serializes NumPy arrays out of band.
+
+    Instead of encoding the data of an array as base64, the array is
+    appended to `frames` and only its header and index are serialized.
+    This way the data can be sent as a separate message frame without
+    being copied. Scalars are serialized like :func:`serialize_numpy`.
+
+    Parameters
+    ----------
+    frames : list
+        The list that arrays are appended to, which should be emptied
+        after each entry has been sent. An array that is serialized more
+        than once for the same entry (e.g. when :func:`get_dumps` falls
+        back to ``json.dumps``) is only appended the first time.
+
+    """
+    # The indices of the arrays in frames, which are only valid as long as
+    # frames isn't emptied
+    indices = {}
+
+    def default(obj):
+        if isinstance(obj, numpy.ndarray) and obj.ndim > 0:
+            if not frames:
+                indices.clear()
+            obj_id = id(obj)
+            obj = _contiguous(obj)
+            dct = _header(obj)
+            index = indices.get(obj_id)
+            if index is None:
+                index = indices[obj_id] = len(frames)
+                frames.append(_c_order(obj))
+            dct['__ndarray_frame__'] = index
+            return dct
+        return serialize_numpy(obj)
+    return default
+
+
+def deserialize_numpy_frames(frames, object_hook=deserialize_numpy):
+    """Create a hook that deserializes arrays sent as separate frames.
+
+    Parameters
+    ----------
+    frames : list
+        The received frames containing the array data, as `bytes` or
+        :class:`zmq.Frame` objects.
+    object_hook : callable, optional
+        Called with all other objects. Defaults to
+        :func:`deserialize_numpy`.
+
+    """
+    def hook(dct):
+        if '__ndarray_frame__' in dct:
+            frame = frames[dct['__ndarray_frame__']]
+            return _from_buffer(getattr(frame, 'buffer', frame), dct)
+        return object_hook(dct)
+    return hook
+
+
+def get_dumps(**kwargs):
+    r"""Create a function that serializes entries to UTF-8 encoded JSON.
+
+    If `orjson` is installed and the keyword arguments can be honoured by
+    it (i.e. only `default` and ``ensure_ascii=False`` are given) it will
+    be used, since it is significantly faster. Otherwise ``json.dumps``
+    is used and its output is encoded.
+
+    orjson writes ``NaN`` and infinity as ``null``, and it can't serialize
+    e.g. named tuples or integers wider than 64 bits. Entries containing
+    non-finite floats or that orjson rejects are therefore serialized by
+    ``json.dumps`` instead, so that the same values are logged either way.
+    Only the whitespace of the output differs.
+
+    Parameters
+    ----------
+    \*\*kwargs
+        Keyword arguments passed on to ``json.dumps``.
+
+    Returns
+    -------
+    dumps : callable
+        A function that takes a log entry and returns `bytes`.
+
+    """
+    def json_dumps(entry):
+        return json.dumps(entry, **kwargs).encode('utf-8')
+
+    if (orjson is not None and kwargs.get('ensure_ascii') is False and
+            set(kwargs) <= {'default', 'ensure_ascii'}):
+        default = kwargs.get('default')
+        # Like json.dumps, allow e.g. integer keys. NumPy arrays are left to
+        # the default function so that their encoding doesn't depend on
+        # whether orjson is installed.
+        option = orjson.OPT_NON_STR_KEYS
+
+        def dumps(entry):
+            try:
+                serialized = orjson.dumps(entry, default=default,
+                                          option=option)
+            except TypeError:
+                return json_dumps(entry)
+            # Could be a non-finite float, which orjson writes as null
+            if b'null' in serialized and _has_non_finite(entry):
+                return json_dumps(entry)
+            return serialized
+    else:
+        dumps = json_dumps
+        if set(kwargs) <= {'default', 'ensure_ascii'}:
+            dumps = _SchemaEncoder(
+                dumps, numpy_scalars=kwargs.get('default') is serialize_numpy,
+                ensure_ascii=kwargs.get('ensure_ascii', True))
+    return dumps
+
+
+def _has_non_finite(obj):
+    """Whether orjson could have written a non-finite float as ``null``.
+
+    Objects that are serialized by the `default` function are assumed to
+    possibly contain non-finite floats, except for NumPy arrays that
+    aren't scalars, whose data isn't serialized as JSON numbers.
+
+    """
+    type_ = type(obj)
+    if type_ is float:
+        return obj - obj != 0.0
+    if type_ is dict:
+        return any(map(_has_non_finite, obj.values()))
+    if type_ is list or type_ is tuple:
+        return any(map(_has_non_finite, obj))
+    if obj is None or type_ in (str, int, bool):
+        return False
+    if isinstance(obj, numpy.ndarray) and obj.ndim > 0:
+        return False
+    if isinstance(obj, (numpy.integer, numpy.bool_)):
+        return False
+    if isinstance(obj, (float, numpy.floating)):
+        return not numpy.isfinite(obj)
+    return True
+
+
+class _SchemaEncoder(object):
+    """Serializes entries that have a fixed schema using generated code.
+
+    Training loops usually log entries with the same keys and value types
+    every time. Once `sample_size` consecutive flat entries of integers
+    and floats have had the same keys (in the same order) and types, a
+    function is generated that serializes such entries with a single
+    string formatting operation. Any entry that doesn't match the schema
+    is serialized by `dumps` instead, after which sampling starts over.
+
+    Parameters
+    ----------
+    dumps : callable
+        The function used to serialize entries without a known schema.
+        Its output must match that of ``json.dumps`` with the default
+        separators.
+    sample_size : int, optional
+        The number of consecutive entries with the same schema required
+        before a specialized function is generated. Defaults to 100.
+    numpy_scalars : bool, optional
+        Whether NumPy integers and floats can be part of the schema, which
+        is only correct if `dumps` serializes them using
+        :func:`serialize_numpy`. Defaults to `False`.
+    ensure_ascii : bool, optional
+        The `ensure_ascii` argument `dumps` was created with, which is
+        used to serialize the keys in the same way. Defaults to `True`.
+
+    """
+    def __init__(self, dumps, sample_size=100, numpy_scalars=False,
+                 ensure_ascii=True):
+        self.dumps = dumps
+        self.sample_size = sample_size
+        self.numpy_scalars = numpy_scalars
+        self.ensure_ascii = ensure_ascii
+        self._encode = None
+        self._schema = None
+        self._count = 0
+
+    def __call__(self, entry):
+        if self._encode is not None:
+            serialized = self._encode(entry)
+            if serialized is not None:
+                return serialized
+        self._sample(entry)
+        return self.dumps(entry)
+
+    def _sample(self, entry):
+        schema = _schema(entry, self.numpy_scalars)
+        if schema != self._schema:
+            self._schema, self._count, self._encode = schema, 0, None
+        if schema and self._encode is None:
+            self._count += 1
+            if self._count >= self.sample_size:
+                self._encode = _compile_encoder(schema, self.ensure_ascii)
+
+
+def _schema(entry, numpy_scalars=False):
+    """Return the keys and value types of a flat numeric entry."""
+    if type(entry) is not dict:
+        return None
+    schema = []
+    for key, value in entry.items():
+        type_ = type(value)
+        if not isinstance(key, str) or not (
+                type_ in (int, float) or numpy_scalars and
+                issubclass(type_, (numpy.integer, numpy.floating))):
+            return None
+        schema.append((key, type_))
+    return tuple(schema)
+
+
+def _compile_encoder(schema, ensure_ascii=True):
+    """Generate a function that serializes entries with the given schema.
+
+    The function returns `None` if the entry doesn't match the schema
+    (including the order of its keys, which is kept in the output), or
+    if it contains floats that aren't finite (since ``json.dumps`` writes
+    those as ``NaN`` and ``Infinity``). NumPy floats are converted to
+    Python floats first, like :func:`serialize_numpy` does.
+
+    """
+    namespace = {'keys': tuple(key for key, _ in schema)}
+    pairs, values, types, conversions, checks = [], [], [], [], []
+    for i, (key, type_) in enumerate(schema):
+        namespace['t{}'.format(i)] = type_
+        value = 'v{}'.format(i)
+        values.append(value)
+        types.append('type({}) is not t{}'.format(value, i))
+        is_float = issubclass(type_, (float, numpy.floating))
+        if is_float:
+            if type_ is not float:
+                conversions.append('    {0} = float({0})'.format(value))
+            checks.append('{0} - {0} != 0.0'.format(value))
+        pairs.append(json.dumps(key, ensure_ascii=ensure_ascii).replace(
+            '%', '%%') + (': %r' if is_float else ': %d'))
+    namespace['template'] = '{' + ', '.join(pairs) + '}'
+
+    lines = [
+        'def encode(entry):',
+        '    if type(entry) is not dict or tuple(entry) != keys:',
+        '        return None',
+        '    {}, = entry.values()'.format(', '.join(values)),
+        '    if {}:'.format(' or '.join(types)),
+        '        return None',
+    ]
+    lines.extend(conversions)
+    if checks:
+        lines.extend(['    if {}:'.format(' or '.join(checks)),
+                      '        return None'])
+    lines.append("    return (template % ({},)).encode('utf-8')".format(
+        ', '.join(values)))
+    exec('\n'.join(lines), namespace)
+    return namespace.pop('encode')
+
+
+def cache_fragments(dumps, keys):
+    """Reuse the serialized values of keys that rarely change.
+
+    Log entries often contain the same sub-objects every time, such as a
+    dictionary of hyperparameters. For the given top-level keys, the
+    serialized key-value pair is cached and reused for as long as the value
+    is the same as the one that was serialized, i.e. equal with the same
+    types and key order throughout (so that e.g. ``1`` and ``1.0`` aren't
+    confused). Cached pairs are placed after the other keys of the entry.
+
+    Parameters
+    ----------
+    dumps : callable
+        A function returned by :func:`get_dumps`.
+    keys : iterable
+        The top-level keys whose values should be cached.
+
+    Returns
+    -------
+    dumps : callable
+        A function that takes a log entry and returns `bytes`.
+
+    """
+    keys = frozenset(keys)
+    # Maps each key to a copy of the value and its serialized pair
+    cache = {}
+
+    def fragment(key, value):
+        cached = cache.get(key)
+        if cached is not None:
+            try:
+                if _same(cached[0], value):
+                    return cached[1]
+            except (TypeError, ValueError):
+                # E.g. NumPy arrays can't be compared this way
+                del cache[key]
+                return dumps({key: value})[1:-1]
+        pair = dumps({key: value})[1:-1]
+        cache[key] = (copy.deepcopy(value), pair)
+        return pair
+
+    def cached_dumps(entry):
+        if not keys.intersection(entry):
+            return dumps(entry)
+        rest, fragments = {}, []
+        for key, value in entry.items():
+            if key in keys:
+                fragments.append(fragment(key, value))
+            else:
+                rest[key] = value
+        if rest:
+            fragments.insert(0, dumps(rest)[1:-1])
+        return b'{' + b','.join(fragments) + b'}'
+    return cached_dumps
+
+
+def _same(a, b):
+    """Whether two values are equal and would be serialized the same."""
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return (len(a) == len(b) and
+                all(_same(key_a, key_b) and _same(a[key_a], b[key_b])
+                    for key_a, key_b in zip(a, b)))
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(map(_same, a, b))
+    if isinstance(a, numpy.ndarray):
+        # Comparing arrays with == broadcasts, and the serialized header
+        # depends on the dtype, shape and memory layout
+        return (a.dtype == b.dtype and a.shape == b.shape and
+                _fortran_order(a) == _fortran_order(b) and
+                a.tobytes() == b.tobytes())
+    if isinstance(a, (float, numpy.floating)):
+        # Tells apart 0.0 and -0.0
+        return repr(a) == repr(b)
+    return a == b
+
+
+def _fortran_order(obj):
+    """Whether an array is serialized in Fortran order."""
+    return obj.flags.f_contiguous and not obj.flags.c_contiguous
+
+
 def loads(entry, **kwargs):
     """Wrapper of ``json.loads`` with sensible defaults"""
     kwargs.setdefault('object_hook', deserialize_numpy)
     return json.loads(entry, **kwargs)
+
+
+def get_loads(**kwargs):
+    r"""Create a function that deserializes UTF-8 encoded JSON entries.
+
+    If no keyword arguments are given, entries that don't contain NumPy
+    arrays are deserialized without an object hook, using `orjson` if it
+    is installed. Entries that orjson rejects (e.g. because they contain
+    ``NaN``) are deserialized by ``json.loads`` instead.
+
+    Parameters
+    ----------
+    \*\*kwargs
+        Keyword arguments passed on to ``json.loads``. By default
+        ``object_hook=deserialize_numpy`` is passed.
+
+    Returns
+    -------
+    loads : callable
+        A function that takes a serialized entry as `bytes` and returns
+        the log entry.
+
+    """
+    kwargs.setdefault('object_hook', deserialize_numpy)
+
+    def json_loads(entry):
+        return json.loads(entry, **kwargs)
+
+    if kwargs != {'object_hook': deserialize_numpy}:
+        return json_loads
+
+    if orjson is None:
+        def loads(entry):
+            if _NDARRAY_MARKER in entry:
+                return json_loads(entry)
+            return json.loads(entry)
+        return loads
+
+    def loads(entry):
+        if _NDARRAY_MARKER in entry:
+            return json_loads(entry)
+        try:
+            return orjson.loads(entry)
+        except orjson.JSONDecodeError:
+            return json_loads(entry)
+    return loads
@@ -5,9 +5,17 @@ be passed on to ``json.loads``. By default NumPy arrays are supported. See
 also the documentation of :func:`recv`.
 
 """
+import threading
+from collections import deque
+
+from six.moves.queue import Queue
 import zmq
 
-from .serialization import loads
+from .logger import _drain
+from .serialization import get_loads
+
+# Used whenever no keyword arguments are given, which is the common case
+_loads = get_loads()
 
 
 def get_snapshot(host='localhost', port=5556, ctx=None, **kwargs):
@@ -20,7 +28,8 @@ def get_snapshot(host='localhost', port=5556, ctx=None, **kwargs):
     port : int, optional
         The port to bind to. Defaults to 5556.
     ctx : :class:`zmq.Context`, optional
-        The context to use. If not given a new one will be created.
+        The context to use. If not given the process-wide instance is
+        used.
 
     Returns
     -------
@@ -34,26 +43,33 @@ def get_snapshot(host='localhost', port=5556, ctx=None, **kwargs):
 
     """
     if not ctx:
-        ctx = zmq.Context()
+        ctx = zmq.Context.instance()
 
     snapshot = ctx.socket(zmq.DEALER)
     snapshot.linger = 0
     snapshot.connect("tcp://{}:{}".format(host, port))
     snapshot.send(b'ICANHAZ?')
 
+    # Each message contains one or more sequence number and entry pairs
+    loads = get_loads(**kwargs)
     sequence = 0
     entries = []
     while True:
-        sequence_, entry = recv(snapshot, **kwargs)
-        if sequence_ < 0:
+        frames = snapshot.recv_multipart()
+        if int(frames[0]) < 0:
             break
-        entries.append(entry)
-        sequence = sequence_
+        entries.extend(map(loads, frames[1::2]))
+        sequence = int(frames[-2])
+    snapshot.close()
 
     return sequence, entries
 
 
-def connect(host='localhost', port=5557, ctx=None):
+# The get_snapshot argument of callback shadows the function
+_get_snapshot = get_snapshot
+
+
+def connect(host='localhost', port=5557, ctx=None, hwm=1000):
     """Subscribe a socket to log entries being published.
 
     Parameters
@@ -63,7 +79,12 @@ def connect(host='localhost', port=5557, ctx=None):
     port : int, optional
         The port to bind to. Defaults to 5557.
     ctx : :class:`zmq.Context`, optional
-        The context to use. If not given a new one will be created.
+        The context to use. If not given the process-wide instance is
+        used.
+    hwm : int, optional
+        The maximum number of entries queued for the subscriber, after
+        which new entries are dropped until it catches up. This bounds the
+        memory used when entries are handled slowly. Defaults to 1000.
 
     Returns
     -------
@@ -72,10 +93,11 @@ def connect(host='localhost', port=5557, ctx=None):
 
     """
     if not ctx:
-        ctx = zmq.Context()
+        ctx = zmq.Context.instance()
 
     subscriber = ctx.socket(zmq.SUB)
     subscriber.linger = 0
+    subscriber.rcvhwm = hwm
     subscriber.setsockopt(zmq.SUBSCRIBE, b'')
     subscriber.connect("tcp://{}:{}".format(host, port))
 
@@ -90,18 +112,25 @@ def recv(s, **kwargs):
     \*\*kwargs
         Keyword arguments will be passed on to ``json.loads``. By default
         ``object_hook=deserialize_numpy`` will be passed to support the
-        deserialization of NumPy arrays and scalars.
+        deserialization of NumPy arrays and scalars. If `orjson` is
+        installed and no keyword arguments are given, it is used instead
+        for entries without NumPy arrays.
 
     """
-    sequence = int(s.recv())
-    entry = loads(s.recv_string(), **kwargs)
-    return sequence, entry
+    loads = get_loads(**kwargs) if kwargs else _loads
+    # The sequence number and entry are sent as one multipart message
+    sequence, entry = s.recv_multipart()
+    return int(sequence), loads(entry)
 
 
 def callback(callback, host='localhost', push_port=5557, router_port=5556,
-             get_snapshot=False, ctx=None, **kwargs):
+             get_snapshot=False, ctx=None, batch_size=1024, background=False,
+             **kwargs):
     """Execute a callback for each log entry.
 
+    All entries that have arrived are received at once before the
+    callback is called with each of them.
+
     Parameters
     ----------
     callback : callable
@@ -121,24 +150,69 @@ def callback(callback, host='localhost', push_port=5557, router_port=5556,
         `stream_maxlen` argument). If False, only new data will come in.
         Defaults to false.
     ctx : :class:`zmq.Context`, optional
-        The context to use. If not given a new one will be created.
+        The context to use. If not given the process-wide instance is
+        used.
+    batch_size : int, optional
+        The maximum number of entries received at once. Defaults to 1024.
+    background : bool, optional
+        If `True`, entries are deserialized and passed to the callback by
+        a background thread, so that a slow callback doesn't delay
+        receiving entries. At most `batch_size` entries are queued, after
+        which receiving waits for the callback to catch up. Exceptions
+        raised by the callback are printed instead of stopping the loop.
+        Defaults to `False`.
 
     """
     if not ctx:
-        ctx = zmq.Context()
+        ctx = zmq.Context.instance()
+
+    # Subscribe first so that no entries are missed after the snapshot
+    subscriber = connect(host=host, port=push_port, ctx=ctx)
 
+    loads = get_loads(**kwargs) if kwargs else _loads
+
+    def handle(entry):
+        callback(loads(entry))
+
+    if background:
+        queue = Queue(maxsize=batch_size)
+        worker = threading.Thread(target=_drain, args=(queue,))
+        worker.daemon = True
+        worker.start()
+
+        def dispatch(function, entry):
+            queue.put((function, entry))
+    else:
+        def dispatch(function, entry):
+            function(entry)
+
+    # Entries up to the last one in the snapshot are skipped, since the
+    # sequence numbers are increasing
     init_sequence = 0
     if get_snapshot:
-        init_sequence, entries = get_snapshot(host=host, port=router_port,
-                                              ctx=ctx, **kwargs)
-        for entry in entries:
-            callback(entry)
+        init_sequence, entries = _get_snapshot(host=host, port=router_port,
+                                               ctx=ctx, **kwargs)
+        if background:
+            for entry in entries:
+                dispatch(callback, entry)
+        else:
+            # Call the callback for each entry without a Python loop
+            deque(map(callback, entries), maxlen=0)
+        del entries
 
-    subscriber = connect(host=host, port=push_port, ctx=ctx)
     while True:
         try:
-            sequence, entry = recv(subscriber, **kwargs)
+            messages = [subscriber.recv_multipart()]
+            for _ in range(batch_size - 1):
+                messages.append(subscriber.recv_multipart(zmq.NOBLOCK))
+        except zmq.Again:
+            pass
         except KeyboardInterrupt:
             break
-        if sequence > init_sequence:
-            callback(entry)
+        for sequence, entry in messages:
+            if int(sequence) > init_sequence:
+                dispatch(handle, entry)
+
+    if background:
+        queue.put(None)
+        worker.join()
@@ -1,26 +1,25 @@
-import binascii
-import codecs
 import gzip
 import io
 import os
 from contextlib import contextmanager
 
-import zmq
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-from .serialization import loads
+from .serialization import get_loads
 
-
-# Taken from github.com/imatix/zguide/blob/master/examples/Python/zhelpers.py
-def zpipe(ctx):
-    """Sets up IPC between two threads."""
-    a = ctx.socket(zmq.PAIR)
-    b = ctx.socket(zmq.PAIR)
-    a.linger = b.linger = 0
-    a.hwm = b.hwm = 1
-    iface = 'inproc://{}'.format(binascii.hexlify(os.urandom(8)))
-    a.bind(iface)
-    b.connect(iface)
-    return a, b
+# Reading gzipped files in large blocks is much faster than 8 KiB at a time
+READ_BUFFER_SIZE = 128 * 1024
 
 
 @contextmanager
@@ -31,23 +30,58 @@ def open(filename, raw_text=False, **kwargs):
     ----------
     filename : str
         The file to read. Assumed to be gzipped if it has extension
-        ``.gz``.
+        ``.gz`` and compressed with Zstandard if it has extension
+        ``.zst``.
     raw_text : bool, optional
         If true then the generator returns the JSON strings, if false it
         deserializes the JSON strings and returns Python objects instead.
         Defaults to false.
+    \*\*kwargs
+        Keyword arguments passed on to ``json.loads``. See
+        :func:`get_loads`.
+
+    """
+    if raw_text:
+        with io.TextIOWrapper(open_binary(filename), encoding='utf-8') as f:
+            yield iter(f)
+    else:
+        # The lines are deserialized as bytes without decoding them first
+        with open_binary(filename) as f:
+            yield map(get_loads(**kwargs), f)
+
+
+def open_binary(filename):
+    """Open a log file for reading its serialized entries as bytes.
+
+    Parameters
+    ----------
+    filename : str
+        The file to read. Assumed to be gzipped if it has extension
+        ``.gz`` and compressed with Zstandard if it has extension
+        ``.zst``. If the `rapidgzip` package is installed, gzipped files
+        are decompressed in parallel using all cores. Otherwise they are
+        decompressed using `isal` if it is installed.
+
+    Returns
+    -------
+    fileobj
+        A binary file object, which can be iterated over to get the
+        UTF-8 encoded lines. It should be closed after use, since
+        `rapidgzip` can't shut down its threads otherwise.
 
     """
-    def read(f):
-        for line in f:
-            if raw_text:
-                yield line
-            else:
-                yield loads(line, **kwargs)
     root, ext = os.path.splitext(filename)
     if ext == '.gz':
-        with codecs.getreader('utf-8')(gzip.open(filename)) as f:
-            yield read(f)
-    else:
-        with io.open(filename) as f:
-            yield read(f)
+        if rapidgzip is not None:
+            f = rapidgzip.open(filename, parallelization=0)
+        elif igzip is not None:
+            f = igzip.open(filename)
+        else:
+            f = gzip.open(filename)
+        return io.BufferedReader(f, buffer_size=READ_BUFFER_SIZE)
+    elif ext == '.zst':
+        if zstandard is None:
+            raise ImportError('reading .zst files requires zstandard')
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+            io.open(filename, 'rb'), closefd=True))
+    return io.open(filename, 'rb')
@@ -31,6 +31,8 @@ setup(
     packages=['mimir'],
     setup_requires=['Cython'],
     install_requires=['pyzmq', 'six', 'simplejson'],
+    extras_require={'fast': ['orjson', 'rapidgzip', 'isal'],
+                    'zstd': ['zstandard']},
     ext_modules=[Extension("mimir.gzlog", ["gzlog/gzlog.pyx"],
                            libraries=['z'])],
     zip_safe=False
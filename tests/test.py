@@ -6,7 +6,7 @@ from mimir.formatters import simple_formatter
 
 logger = Logger()
 
-json_log = open('log.json', 'w')
+json_log = open('log.json', 'wb')
 logger.handlers = [PrintHandler(simple_formatter),
                    JSONHandler(json_log),
                    GzipJSONHandler('log.json'),
@@ -0,0 +1,209 @@
+"""Checks of the generated and specialized code paths.
+
+Can be run directly with ``python tests/test_internals.py`` or with pytest.
+
+"""
+import itertools
+import threading
+
+import numpy
+import simplejson as json
+
+from mimir.handlers import Handler
+from mimir.logger import _ColumnStore, _Logger
+from mimir.remote import RemoteLogger, ServerLogger
+from mimir.serialization import (_SchemaEncoder, cache_fragments, get_dumps,
+                                 loads, serialize_numpy)
+
+
+class RecordingHandler(Handler):
+    def __init__(self, records, name, json_=False, **kwargs):
+        super(RecordingHandler, self).__init__(**kwargs)
+        self.records = records
+        self.name = name
+        self.JSON = json_
+
+    def log(self, entry):
+        self.records.append((self.name, entry))
+
+
+class OverriddenFilterHandler(RecordingHandler):
+    def filter(self, entry):
+        return dict(entry, overridden=True)
+
+
+def reference_log(logger, entry):
+    """The loop that the generated log functions replace."""
+    filtered_entries = {}
+    serialized_entries = {}
+    for handler in logger.handlers:
+        if handler.predicate is not None and not handler.predicate(entry):
+            continue
+        key = frozenset(handler.filters)
+        if handler.filters:
+            if key not in filtered_entries:
+                filtered_entries[key] = handler.filter(entry)
+            filtered_entry = filtered_entries[key]
+        else:
+            filtered_entry = entry
+        if handler.JSON:
+            if key not in serialized_entries:
+                serialized_entries[key] = logger._dumps(filtered_entry)
+            handler.log(serialized_entries[key])
+        else:
+            handler.log(filtered_entry)
+
+
+def add_square(entry):
+    return dict(entry, square=entry['i'] ** 2)
+
+
+def drop_i(entry):
+    return dict((k, v) for k, v in entry.items() if k != 'i')
+
+
+def even(entry):
+    return entry['i'] % 2 == 0
+
+
+def every_third(entry):
+    return entry['i'] % 3 == 0
+
+
+def make_handlers(records):
+    configs = itertools.product(
+        [(), (add_square,), (add_square, drop_i)], [None, even, every_third],
+        [False, True])
+    handlers = [RecordingHandler(records, i, json_, filters=filters,
+                                 predicate=predicate)
+                for i, (filters, predicate, json_) in enumerate(configs)]
+    handlers.append(OverriddenFilterHandler(
+        records, len(handlers), True, filters=(add_square,), predicate=even))
+    return handlers
+
+
+def test_compiled_log_matches_reference():
+    for background in (False, True):
+        compiled, reference = [], []
+        logger = _Logger(make_handlers(compiled), background=background)
+        reference_logger = _Logger(make_handlers(reference))
+        entries = [{'i': i, 'x': i / 7.} for i in range(12)]
+        for entry in entries:
+            logger.log(entry)
+            reference_log(reference_logger, entry)
+        logger.close()
+        assert compiled == reference
+        # Filtered entries are shared between handlers with the same filters
+        assert len(set(id(entry) for _, entry in compiled)) < len(compiled)
+
+
+def test_compiled_log_follows_handler_changes():
+    records = []
+    handler = RecordingHandler(records, 0)
+    logger = _Logger([handler])
+    logger.log({'i': 1})
+    handler.filters = [add_square]
+    logger.log({'i': 2})
+    handler.predicate = even
+    logger.log({'i': 3})
+    logger.handlers.sort(key=lambda handler: handler.name)
+    logger.log({'i': 4})
+    assert records == [(0, {'i': 1}), (0, {'i': 2, 'square': 4}),
+                       (0, {'i': 4, 'square': 16})]
+
+
+def test_schema_encoder_matches_json_dumps():
+    entries = [{'iteration': i, u'\xe9rror': 1. / (i + 1),
+                'cost': numpy.float32(i) / 3, 'step': numpy.int64(i)}
+               for i in range(20)]
+    entries += [{'iteration': 1, u'\xe9rror': value, 'cost': 0.,
+                 'step': numpy.int64(0)}
+                for value in (-0., 1e300, float('nan'), float('inf'))]
+    # Same keys in a different order, and different types
+    entries += [{'step': numpy.int64(1), 'cost': 0., u'\xe9rror': 1.,
+                 'iteration': 1},
+                {'iteration': 1., u'\xe9rror': 1, 'cost': 0.,
+                 'step': numpy.int64(1)}]
+    for ensure_ascii in (True, False):
+        kwargs = dict(ensure_ascii=ensure_ascii, default=serialize_numpy,
+                      allow_nan=True)
+
+        def dumps(entry):
+            return json.dumps(entry, **kwargs).encode('utf-8')
+        encoder = _SchemaEncoder(dumps, sample_size=5, numpy_scalars=True,
+                                 ensure_ascii=ensure_ascii)
+        for entry in entries + entries[:10]:
+            assert encoder(entry) == dumps(entry)
+        assert encoder._encode is not None
+
+
+def test_get_dumps_round_trips():
+    dumps = get_dumps(ensure_ascii=False, default=serialize_numpy)
+    entry = {'note': None, 'path': '/dev/null', 'big': 2 ** 70,
+             'array': numpy.arange(3.), 'nested': [{'x': -0.5}]}
+    loaded = loads(dumps(entry))
+    assert loaded['big'] == 2 ** 70 and loaded['note'] is None
+    assert (loaded['array'] == entry['array']).all()
+    assert loaded['nested'] == entry['nested']
+
+
+def test_cache_fragments():
+    dumps = get_dumps(ensure_ascii=False, default=serialize_numpy)
+    cached_dumps = cache_fragments(dumps, ['params'])
+    values = [{'lr': 1}, {'lr': 1}, {'lr': 1.}, {'lr': True}, [1, 2], (1, 2),
+              -0., 0., numpy.array([1]), numpy.array([True]),
+              numpy.array([[1]]), numpy.array([[1]]), None]
+    for value in values:
+        # The cached fragment must be the one that would be serialized now
+        expected = b'{' + b','.join([dumps({'i': 1})[1:-1],
+                                     dumps({'params': value})[1:-1]]) + b'}'
+        assert cached_dumps({'i': 1, 'params': value}) == expected
+
+
+def test_column_store_ring_buffer():
+    store = _ColumnStore({'i': 'int64', 'x': 'float32'}, maxlen=5)
+    for i in range(13):
+        store.append({'i': i, 'x': i / 2.})
+        expected = list(range(max(0, i - 4), i + 1))
+        assert len(store) == len(expected)
+        assert [store[j]['i'] for j in range(len(store))] == expected
+        assert store.column('i').tolist() == expected
+        assert store.column('x').tolist() == [j / 2. for j in expected]
+    assert store[-1] == {'i': 12, 'x': 6.}
+
+
+def test_column_store_growth():
+    store = _ColumnStore({'i': 'int64'})
+    store.extend({'i': i} for i in range(3000))
+    assert len(store) == 3000 and store._capacity == 4096
+    assert store.column('i').tolist() == list(range(3000))
+    assert store[-1] == {'i': 2999}
+    empty = _ColumnStore({'i': 'int64'}, maxlen=0)
+    empty.append({'i': 1})
+    assert len(empty) == 0
+
+
+def test_remote_logger_window():
+    servers = []
+    server_thread = threading.Thread(target=lambda: servers.append(
+        ServerLogger(port=5599, maxlen=None, formatter=None)))
+    server_thread.start()
+    with RemoteLogger(name='a', port=5599, window=2) as remote:
+        for i in range(50):
+            # Fall back to json.dumps every few entries
+            remote.log({'i': i, 'array': numpy.arange(i % 4 + 1.),
+                        'big': 2 ** 70 if i % 5 == 0 else 0})
+            assert remote._pending <= 2
+    server_thread.join()
+    entries = list(servers[0])
+    assert [entry['i'] for entry in entries] == list(range(50))
+    for entry in entries:
+        assert entry['remote_log'] == 'a'
+        assert entry['array'].tolist() == list(range(entry['i'] % 4 + 1))
+
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print('{}: ok'.format(name))
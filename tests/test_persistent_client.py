@@ -12,21 +12,20 @@ subscriber.linger = 0
 subscriber.setsockopt(zmq.SUBSCRIBE, b'')
 subscriber.connect("tcp://localhost:5557")
 
-store = {}
-
 sequence = 0
 snapshot.send(b'ICANHAZ?')
 while True:
-    sequence = int(snapshot.recv())
-    entry = json.loads(snapshot.recv_string())
-    if sequence < 0:
+    frames = snapshot.recv_multipart()
+    if int(frames[0]) < 0:
         break
-    store[sequence] = entry
-    print('{}: {}'.format(sequence, entry))
+    for sequence, entry in zip(frames[::2], frames[1::2]):
+        sequence, entry = int(sequence), json.loads(entry)
+        print('{}: {}'.format(sequence, entry))
 
+# Sequence numbers are increasing, so skip those in the snapshot
+last_sequence = sequence
 while True:
     sequence = int(subscriber.recv())
     entry = json.loads(subscriber.recv_string())
-    if sequence not in store:
-        store[sequence] = entry
+    if sequence > last_sequence:
         print('{}: {}'.format(sequence, entry))